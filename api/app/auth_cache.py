@@ -0,0 +1,135 @@
+import hashlib
+import jwt
+import orjson
+import threading
+import time
+
+from cachetools import TTLCache
+
+from app.config import get_settings
+
+JWT_KEY_BYTES = get_settings().jwt_key.encode("utf-8")
+
+CACHE_TTL = 30
+VERIFY_CACHE_TTL = 5
+
+class OrjsonJWT(jwt.PyJWT):
+    """
+    PyJWT decoder that parses the token claims with orjson.
+
+    `_decode_payload` is the hook PyJWT provides for subclasses that decode
+    the payload differently; signature and claim validation are unchanged.
+    """
+
+    def _decode_payload(self, decoded: dict) -> dict:
+        try:
+            payload = orjson.loads(decoded["payload"])
+        except orjson.JSONDecodeError as e:
+            raise jwt.DecodeError(f"Invalid payload string: {e}") from e
+        if not isinstance(payload, dict):
+            raise jwt.DecodeError("Invalid payload string: must be a json object")
+        return payload
+
+_jwt = OrjsonJWT()
+
+_payload_cache = TTLCache(maxsize=10000, ttl=CACHE_TTL)
+_payload_lock = threading.Lock()
+
+_verify_cache = TTLCache(maxsize=10000, ttl=VERIFY_CACHE_TTL)
+_verify_lock = threading.Lock()
+
+def _token_key(token: str) -> bytes:
+    """
+    Return the cache key for a token.
+
+    Raw tokens are never stored, only their 16 byte BLAKE2b digest.
+    """
+    return hashlib.blake2b(token.encode(), digest_size=16).digest()
+
+def decode_cached(token: str) -> dict:
+    """
+    Decode and verify an access token, reusing recently verified payloads.
+
+    The payload of a successfully verified token is kept for at most
+    CACHE_TTL seconds and never past the token's own expiration time, so
+    expired tokens still fail with the same errors as `jwt.decode`.
+
+    Args:
+        token (str): The access token to decode.
+
+    Returns:
+        dict: The decoded token payload.
+
+    Raises:
+        jwt.ExpiredSignatureError: If the token has expired.
+        jwt.InvalidTokenError: If the token is invalid or misses the exp or email claim.
+    """
+    key = _token_key(token)
+    now = time.time()
+
+    with _payload_lock:
+        cached = _payload_cache.get(key)
+    if cached:
+        payload, valid_until = cached
+        if now < valid_until:
+            return payload
+
+    payload = _jwt.decode(token, JWT_KEY_BYTES, algorithms=["HS256"], options={"require": ["exp", "email"]})
+
+    valid_until = min(payload["exp"], now + CACHE_TTL)
+    with _payload_lock:
+        _payload_cache[key] = (payload, valid_until)
+
+    return payload
+
+def get_verified_user(token: str):
+    """
+    Return the user cached for a recently verified token.
+
+    Args:
+        token (str): The access token.
+
+    Returns:
+        The user stored with `cache_verified_user`, or None if the token was
+        not verified in the last VERIFY_CACHE_TTL seconds.
+    """
+    key = _token_key(token)
+
+    with _verify_lock:
+        cached = _verify_cache.get(key)
+    if cached:
+        user, valid_until = cached
+        if time.time() < valid_until:
+            return user
+
+    return None
+
+def cache_verified_user(token: str, user, expires_at: float | None = None):
+    """
+    Remember the user of a fully verified token.
+
+    The entry is kept for at most VERIFY_CACHE_TTL seconds and never past the
+    token's expiration time. Disabling a user therefore takes effect within
+    VERIFY_CACHE_TTL seconds.
+
+    Args:
+        token (str): The verified access token.
+        user: The user the token belongs to.
+        expires_at (float | None): The token's `exp` claim.
+    """
+    valid_until = time.time() + VERIFY_CACHE_TTL
+    if expires_at is not None:
+        valid_until = min(expires_at, valid_until)
+
+    with _verify_lock:
+        _verify_cache[_token_key(token)] = (user, valid_until)
+
+def forget_token(token: str):
+    """
+    Drop a token from the verification cache, e.g. after it was revoked.
+
+    Args:
+        token (str): The access token.
+    """
+    with _verify_lock:
+        _verify_cache.pop(_token_key(token), None)
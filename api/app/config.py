@@ -0,0 +1,36 @@
+from functools import lru_cache
+from pathlib import Path
+from typing import Optional
+
+from pydantic_settings import BaseSettings, SettingsConfigDict
+
+class Settings(BaseSettings):
+    """
+    Application settings read from the environment and the `api/.env` file,
+    which is found next to the app package whatever the working directory is.
+
+    Attributes:
+    database_name: Path of the SQLite database file.
+    jwt_key: Secret key used to sign and verify access tokens.
+    openai_key: API key for the OpenAI chat completions endpoint.
+    key: Secret key for the reset endpoints.
+    """
+    model_config = SettingsConfigDict(env_file=Path(__file__).resolve().parent.parent / ".env", extra="ignore")
+
+    database_name: str
+    jwt_key: str
+    openai_key: Optional[str] = None
+    key: Optional[str] = None
+
+@lru_cache
+def get_settings() -> Settings:
+    """
+    Return the application settings.
+
+    The environment is read once per process and the same settings object
+    is returned on every later call.
+
+    Returns:
+    The application settings.
+    """
+    return Settings()
@@ -1,15 +1,44 @@
+import aiohttp
+import orjson
+
 from contextlib import asynccontextmanager
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
 from sqlmodel import Session, create_engine, SQLModel
-from dotenv import load_dotenv
-
-import os
+from app.config import get_settings
 
-load_dotenv()
-sqlite_file_name = os.getenv("DATABASE_NAME")
+sqlite_file_name = get_settings().database_name
 sqlite_url = f"sqlite:///{sqlite_file_name}"
 connect_args = {"check_same_thread": False}
-engine = create_engine(sqlite_url, connect_args=connect_args)
+engine = create_engine(
+    sqlite_url,
+    connect_args=connect_args,
+    poolclass=QueuePool,
+    json_serializer=lambda obj: orjson.dumps(obj).decode("utf-8"),
+    json_deserializer=orjson.loads
+)
+
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-64000",
+    "PRAGMA mmap_size=268435456",
+)
+
+@event.listens_for(engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """
+    Configure every new SQLite connection.
+
+    WAL lets readers run while a write is in progress, and the remaining
+    pragmas keep temporary tables and a larger page cache in memory.
+    """
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
 
 def create_db_and_tables():
     """
@@ -17,9 +46,61 @@ def create_db_and_tables():
 
     This function initializes the database by creating all the tables
     defined in the SQLModel metadata using the configured database engine.
+    Indexes are created separately as well, since `create_all` skips tables
+    that already exist and would not add indexes introduced later.
     """
 
     SQLModel.metadata.create_all(engine)
+    dedupe_revoked_tokens()
+    for table in SQLModel.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+
+    migrate_chat_history()
+
+def dedupe_revoked_tokens():
+    """
+    Remove duplicate rows from `revokedtoken` before its token index is created.
+
+    Older databases had no unique index on the token, so revoking a token twice
+    stored it twice, and creating the index would fail. Only the first row of
+    each token is kept, and this is a no-op once the index exists.
+    """
+    with engine.begin() as connection:
+        indexes = [row[1] for row in connection.exec_driver_sql("PRAGMA index_list(revokedtoken)")]
+        if "ix_revokedtoken_token" in indexes:
+            return
+
+        connection.exec_driver_sql(
+            "DELETE FROM revokedtoken WHERE id NOT IN (SELECT MIN(id) FROM revokedtoken GROUP BY token)"
+        )
+
+def migrate_chat_history():
+    """
+    Move chat histories out of the legacy `evaluation.chat_history` column.
+
+    Older databases stored the whole conversation as one serialized blob per
+    evaluation. Each message is copied into its own `chatmessage` row and the
+    column is dropped afterwards, so this is a no-op once it has run.
+    """
+    with engine.begin() as connection:
+        columns = [row[1] for row in connection.exec_driver_sql("PRAGMA table_info(evaluation)")]
+        if "chat_history" not in columns:
+            return
+
+        rows = connection.exec_driver_sql("SELECT id, timestamp, chat_history FROM evaluation").all()
+        for evaluation_id, timestamp, chat_history in rows:
+            messages = [
+                (evaluation_id, seq, message["role"], orjson.dumps(message["content"]).decode("utf-8"), timestamp)
+                for seq, message in enumerate(orjson.loads(chat_history))
+            ]
+            if messages:
+                connection.exec_driver_sql(
+                    "INSERT INTO chatmessage (evaluation_id, seq, role, content, created_at) VALUES (?, ?, ?, ?, ?)",
+                    messages
+                )
+
+        connection.exec_driver_sql("ALTER TABLE evaluation DROP COLUMN chat_history")
 
 def get_session():
     """
@@ -27,12 +108,35 @@ def get_session():
 
     Yields a database session that will be closed when the response is sent.
     This is a context manager that will be used by FastAPI as a dependency.
-    The session is created using the configured database engine.
+    The session is created using the configured database engine. Objects
+    are not expired on commit, so handlers can return what they just wrote
+    without reloading it from the database.
     """
-    with Session(engine) as session:
+    with Session(engine, expire_on_commit=False) as session:
         yield session
 
+def get_http_session(request: Request) -> aiohttp.ClientSession:
+    """
+    FastAPI dependency that returns the shared HTTP client session.
+
+    The session is created once in the application lifespan, so outgoing
+    requests reuse its connection pool instead of opening a new TCP and
+    TLS connection for every call.
+    """
+    return request.app.state.http
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     create_db_and_tables()
+    connector = aiohttp.TCPConnector(
+        limit=200,
+        limit_per_host=64,
+        ttl_dns_cache=600,
+        keepalive_timeout=75
+    )
+    app.state.http = aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(total=30, connect=5, sock_read=25)
+    )
     yield
+    await app.state.http.close()
@@ -1,9 +1,10 @@
 from fastapi import  FastAPI
+from fastapi.responses import ORJSONResponse
 
 from .dependencies import lifespan
 from .routers import users, charts, evaluations, reset
 
-app = FastAPI(lifespan=lifespan)
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 app.include_router(users.router)
 app.include_router(charts.router)
@@ -1,11 +1,13 @@
 import re
 
 from typing import Annotated, Optional
-from fastapi import APIRouter, Depends, HTTPException, Header
+from fastapi import APIRouter, Depends, HTTPException
 from sqlmodel import Field, SQLModel, Session, select
 
 from app.dependencies import get_session
-from app.routers.users import verify_if_admin, verify_user
+from app.routers.users import admin_user, current_user
+
+CHART_NAME_PATTERN = re.compile(r"[a-z0-9-]+")
 
 class ChartBase(SQLModel):
     name: str
@@ -36,8 +38,8 @@ router = APIRouter(
 
 SessionDep = Annotated[Session, Depends(get_session)] 
 
-@router.post("/")
-def create_chart(chart: ChartCreate, session: SessionDep, authorization: str = Header()):
+@router.post("/", dependencies=[Depends(admin_user)])
+def create_chart(chart: ChartCreate, session: SessionDep):
 
     """
     Create a new chart.
@@ -55,17 +57,11 @@ def create_chart(chart: ChartCreate, session: SessionDep, authorization: str = H
     HTTPException: 401 if the access token is invalid.
     HTTPException: 400 if the chart name contains invalid characters or a chart with the same filename already exists.
     """
-    if not authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Invalid token format")
-    token = authorization.split(" ")[1]
-
-    verify_if_admin(token, session)
-
-    if not re.fullmatch(r"[a-z0-9-]+", chart.name):
+    if not CHART_NAME_PATTERN.fullmatch(chart.name):
         raise HTTPException(status_code=400, detail="Chart name can only contain lowercase alphanumeric characters and hyphens")
 
-    statement = select(Chart).where(Chart.name == chart.name)
-    if session.exec(statement).first():
+    statement = select(1).where(Chart.name == chart.name).limit(1)
+    if session.exec(statement).first() is not None:
         raise HTTPException(status_code=400, detail="Chart with this filename already exists")
     
     db_chart = Chart(
@@ -76,12 +72,11 @@ def create_chart(chart: ChartCreate, session: SessionDep, authorization: str = H
     )
     session.add(db_chart)
     session.commit()
-    session.refresh(db_chart)
 
     return db_chart
 
-@router.get("/{filename}")
-async def get_chart(filename: str, session: SessionDep, authorization: str = Header()):
+@router.get("/{filename}", dependencies=[Depends(current_user)])
+def get_chart(filename: str, session: SessionDep):
     """
     Retrieve a chart by filename.
 
@@ -90,7 +85,6 @@ async def get_chart(filename: str, session: SessionDep, authorization: str = Hea
     Args:
     filename: The filename of the chart to retrieve.
     session: The database session.
-    authorization: The Bearer token for user verification.
 
     Returns:
     The requested chart if found.
@@ -100,20 +94,14 @@ async def get_chart(filename: str, session: SessionDep, authorization: str = Hea
     HTTPException: 404 if the chart is not found.
     """
 
-    if not authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Invalid token format")
-    token = authorization.split(" ")[1]
-
-    await verify_user(token, session)
-
     db_chart = session.get(Chart, filename)
     if not db_chart:
         raise HTTPException(status_code=404, detail="Chart not found")
 
     return db_chart
 
-@router.get("/", response_model=list[ChartBase])
-async def list_charts(session: SessionDep, authorization: str = Header()):
+@router.get("/", response_model=list[ChartBase], dependencies=[Depends(current_user)])
+def list_charts(session: SessionDep):
     """
     List all charts.
 
@@ -121,7 +109,6 @@ async def list_charts(session: SessionDep, authorization: str = Header()):
 
     Args:
     session: The database session.
-    authorization: The Bearer token for user verification.
 
     Returns:
     A list of all charts.
@@ -129,19 +116,13 @@ async def list_charts(session: SessionDep, authorization: str = Header()):
     Raises:
     HTTPException: 401 if the token is invalid.
     """
-    if not authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Invalid token format")
-    token = authorization.split(" ")[1]
-
-    await verify_user(token, session)
-
-    statement = select(Chart)
+    statement = select(Chart.name, Chart.description, Chart.instruction, Chart.url)
     charts = session.exec(statement).all()
 
     return charts
 
-@router.put("/{filename}", response_model=ChartBase)
-async def update_chart(filename: str, chart: ChartUpdate, session: SessionDep, authorization: str = Header()):
+@router.put("/{filename}", response_model=ChartBase, dependencies=[Depends(admin_user)])
+def update_chart(filename: str, chart: ChartUpdate, session: SessionDep):
     """
     Update a chart.
 
@@ -152,7 +133,6 @@ async def update_chart(filename: str, chart: ChartUpdate, session: SessionDep, a
     filename: The filename of the chart to update.
     chart: The chart data to update.
     session: The database session.
-    authorization: The Bearer token for user verification.
 
     Returns:
     The updated chart.
@@ -162,27 +142,19 @@ async def update_chart(filename: str, chart: ChartUpdate, session: SessionDep, a
     HTTPException: 404 if the chart is not found.
     """
 
-    if not authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Invalid token format")
-    token = authorization.split(" ")[1]
-
-    verify_if_admin(token, session)
-
     db_chart = session.get(Chart, filename)
     if not db_chart:
         raise HTTPException(status_code=404, detail="Chart not found")
 
-    chart_data = chart.model_dump(exclude_unset=True)
-    for key, value in chart_data.items():
-        setattr(db_chart, key, value)
+    for key in chart.model_fields_set:
+        setattr(db_chart, key, getattr(chart, key))
 
     session.commit()
-    session.refresh(db_chart)
 
     return db_chart
 
-@router.delete("/{filename}", status_code=204)
-async def delete_chart(filename: str, session: SessionDep, authorization: str = Header()):
+@router.delete("/{filename}", status_code=204, dependencies=[Depends(admin_user)])
+def delete_chart(filename: str, session: SessionDep):
     """
     Delete a chart by filename.
 
@@ -191,7 +163,6 @@ async def delete_chart(filename: str, session: SessionDep, authorization: str =
     Args:
     filename: The filename of the chart to delete.
     session: The database session.
-    authorization: The Bearer token for user verification.
 
     Returns:
     None
@@ -200,12 +171,6 @@ async def delete_chart(filename: str, session: SessionDep, authorization: str =
     HTTPException: 401 if the token is invalid or the user is not an admin.
     HTTPException: 404 if the chart is not found.
     """
-    if not authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Invalid token format")
-    token = authorization.split(" ")[1]
-
-    verify_if_admin(token, session)
-
     db_chart = session.get(Chart, filename)
     if not db_chart:
         raise HTTPException(status_code=404, detail="Chart not found")
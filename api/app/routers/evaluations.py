@@ -1,31 +1,57 @@
 import aiohttp
 import asyncio
-import jwt
-import json
-import os
+import orjson
+from contextlib import asynccontextmanager
 from datetime import datetime, timezone
 from typing import Annotated
-from dotenv import load_dotenv
-from fastapi import APIRouter, Depends, HTTPException, Header
-from sqlmodel import Field, SQLModel, Session, select
+from fastapi import APIRouter, Depends, Header, HTTPException, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from sqlmodel import JSON, Column, Field, Index, SQLModel, Session, select
 from pydantic import BaseModel
-from app.dependencies import get_session
+from app.config import get_settings
+from app.dependencies import engine, get_http_session, get_session
 from app.routers.charts import Chart
-from app.routers.users import verify_user
+from app.routers.users import CurrentUserDep, UserBase
 
-load_dotenv()
-JWT_KEY = os.getenv("JWT_KEY")
-OPENAI_KEY = os.getenv("OPENAI_KEY")
+OPENAI_KEY = get_settings().openai_key
+OPENAI_URL = "https://api.openai.com/v1/chat/completions"
+
+MAX_TURNS = 20
+
+OPENAI_RETRY_STATUSES = (502, 503, 504)
+OPENAI_RETRIES = 2
+OPENAI_BACKOFF = 0.2
 
 class EvaluationBase(SQLModel):
     pass
 
 class Evaluation(EvaluationBase, table=True):
+    __table_args__ = (Index("ix_evaluation_email_chart_timestamp", "email", "chart", "timestamp"),)
+
     id: int | None = Field(default=None, primary_key=True)
     email: str = Field(foreign_key="user.email")
     chart: str = Field(foreign_key="chart.name")
     timestamp: datetime
-    chat_history: bytes
+
+class ChatMessage(SQLModel, table=True):
+    __table_args__ = (Index("ix_chatmessage_evaluation_seq", "evaluation_id", "seq"),)
+
+    id: int | None = Field(default=None, primary_key=True)
+    evaluation_id: int = Field(foreign_key="evaluation.id")
+    seq: int
+    role: str
+    content: str | list = Field(sa_column=Column(JSON, nullable=False))
+    created_at: datetime
+
+class EvaluationMeta(EvaluationBase):
+    id: int
+    email: str
+    chart: str
+    timestamp: datetime
+
+class EvaluationRead(EvaluationMeta):
+    chat_history: list[dict]
 
 class Question(BaseModel):
     question: str
@@ -36,95 +62,180 @@ router = APIRouter(
 )
 
 SessionDep = Annotated[Session, Depends(get_session)] 
+HttpSessionDep = Annotated[aiohttp.ClientSession, Depends(get_http_session)]
 
 
 # Check if evaluation exists for current user and chart, evaluations need to be sorted by timestamp (latest first)
 # If evaluation exists, return it, else create a new one
-@router.get("/{email}/{chart}")
-async def get_evaluation(email: str, chart: str, session: SessionDep, authorization: str = Header()):
+@router.get("/{email}/{chart}", response_model=EvaluationRead)
+def get_evaluation(email: str, chart: str, session: SessionDep, user: CurrentUserDep, response: Response, if_none_match: Annotated[str | None, Header()] = None):
     """
     Get an evaluation for a user and chart.
 
+    The response carries an ETag for the current state of the evaluation. If
+    the client sends it back in If-None-Match and the evaluation has not
+    changed, a 304 is returned without loading the chat history.
+
     Args:
-    user (str): The email of the user to get the evaluation for.
+    email (str): The email of the user to get the evaluation for.
     chart (str): The name of the chart to get the evaluation for.
     session (SessionDep): The database session.
-    authorization (str = Header()): The Bearer token to verify the user.
+    user (CurrentUserDep): The user of the access token.
+    response (Response): The response, used to set the ETag header.
+    if_none_match (str | None): The ETag of the evaluation the client already has.
 
     Returns:
-    Evaluation: The evaluation for the user and chart.
+    EvaluationRead: The evaluation for the user and chart with its chat history.
 
     Raises:
     HTTPException: 400 if the user and chart are not provided.
     HTTPException: 401 if the token is invalid or the user is not authorized to access the evaluation.
     HTTPException: 404 if the evaluation is not found.
     """
-    if not authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Invalid token format")
-    token = authorization.split(" ")[1]
-
     if not email or not chart:
         raise HTTPException(status_code=400, detail="User and chart must be provided")
-    
-    await verify_user(token, session)
 
-    payload = jwt.decode(token, JWT_KEY, algorithms=["HS256"])
-    if payload["email"] != email:
-        raise HTTPException(status_code=401, detail=f"'{payload['email']}' is not authorized to access evaluation for '{email}'")
+    if user.email != email:
+        raise HTTPException(status_code=401, detail=f"'{user.email}' is not authorized to access evaluation for '{email}'")
 
-
-    statement = select(Evaluation).where(Evaluation.email == email).where(Evaluation.chart == chart).order_by(Evaluation.timestamp)
+    statement = select(Evaluation).where(Evaluation.email == email).where(Evaluation.chart == chart).order_by(Evaluation.timestamp.desc()).limit(1)
     evaluation = session.exec(statement).first()
 
     if not evaluation:
         raise HTTPException(status_code=404, detail="Evaluation not found")
 
-    return evaluation
+    etag = evaluation_etag(evaluation)
+    if if_none_match == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+
+    chat_history = load_chat_history(evaluation.id, session)
 
-@router.post("/{email}/{chart}")
-async def ask_question(email: str, chart: str, question: Question, session: SessionDep, authorization: str = Header()):
+    response.headers["ETag"] = etag
+    return EvaluationRead(**evaluation.model_dump(), chat_history=chat_history)
+
+@router.post("/{email}/{chart}", response_model=EvaluationMeta)
+async def ask_question(email: str, chart: str, question: Question, session: SessionDep, http: HttpSessionDep, user: CurrentUserDep):
     """
     Handle a user's question for a specific chart evaluation.
 
     This endpoint allows a user to ask a question related to a specific chart.
     It verifies the user's authorization and checks for the existence of an
     evaluation. If the evaluation does not exist, it creates a new one. If it
-    does, it appends the new question to the existing chat history.
+    does, it appends the new question to the existing chat history. Only the
+    new messages are written, one row per message, and only the last
+    MAX_TURNS question/answer pairs are sent to OpenAI. The database work
+    runs in the threadpool, so it does not block the event loop.
+
+    Args:
+    email (str): The email of the user asking the question.
+    chart (str): The name of the chart related to the question.
+    question (Question): The question being asked.
+    session (SessionDep): The database session.
+    http (HttpSessionDep): The shared HTTP client session used to call OpenAI.
+    user (CurrentUserDep): The user of the access token.
+
+    Returns:
+    EvaluationMeta: The updated or newly created evaluation without the chat history,
+    which can be fetched with the GET endpoint.
+
+    Raises:
+    HTTPException: 400 if user, chart, or question is not provided.
+    HTTPException: 401 if the token is invalid or user is not authorized.
+    HTTPException: 404 if the chart is not found.
+    """
+
+    db_evaluation, chat_history, new_messages, next_seq = await run_in_threadpool(prepare_question, email, chart, question, session, user)
+
+    chat = await send_request_to_openai(chat_history + new_messages, http)
+    new_messages.append(chat[-1])
+
+    await run_in_threadpool(save_messages, db_evaluation, new_messages, next_seq, session)
+
+    return db_evaluation
+
+@router.post("/{email}/{chart}/stream")
+async def ask_question_stream(email: str, chart: str, question: Question, session: SessionDep, http: HttpSessionDep, user: CurrentUserDep):
+    """
+    Handle a user's question for a specific chart evaluation and stream the answer.
+
+    This endpoint works like the POST endpoint without `/stream`, but returns
+    the answer as Server-Sent Events while OpenAI generates it. Every event
+    carries a JSON object with a `type`:
+
+    - `delta`: the next part of the answer in `content`.
+    - `done`: the answer is complete and saved, `evaluation` holds the
+      updated evaluation without the chat history.
+    - `error`: the answer could not be generated, `detail` holds the reason.
+      Nothing is saved in that case.
 
     Args:
     email (str): The email of the user asking the question.
     chart (str): The name of the chart related to the question.
     question (Question): The question being asked.
     session (SessionDep): The database session.
-    authorization (str, optional): The Bearer token for user verification.
+    http (HttpSessionDep): The shared HTTP client session used to call OpenAI.
+    user (CurrentUserDep): The user of the access token.
 
     Returns:
-    Evaluation: The updated or newly created evaluation containing the chat history.
+    StreamingResponse: The `text/event-stream` of the answer.
 
     Raises:
     HTTPException: 400 if user, chart, or question is not provided.
     HTTPException: 401 if the token is invalid or user is not authorized.
     HTTPException: 404 if the chart is not found.
-    HTTPException: 500 if there is an error decoding existing chat history.
     """
-    
-    if not authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Invalid token format")
-    token = authorization.split(" ")[1]
+    db_evaluation, chat_history, new_messages, next_seq = await run_in_threadpool(prepare_question, email, chart, question, session, user)
+
+    async def events():
+        parts = []
+        try:
+            async for part in stream_openai_answer(chat_history + new_messages, http):
+                parts.append(part)
+                yield server_sent_event({"type": "delta", "content": part})
+        except HTTPException as e:
+            yield server_sent_event({"type": "error", "detail": e.detail})
+            return
+
+        new_messages.append({"role": "assistant", "content": "".join(parts)})
+
+        await run_in_threadpool(save_streamed_messages, db_evaluation, new_messages, next_seq)
+
+        evaluation = EvaluationMeta.model_validate(db_evaluation)
+        yield server_sent_event({"type": "done", "evaluation": evaluation.model_dump(mode="json")})
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+def prepare_question(email: str, chart: str, question: Question, session: Session, user: UserBase) -> tuple[Evaluation, list[dict], list[dict], int]:
+    """
+    Check a question and build the messages to send to OpenAI with it.
+
+    Args:
+    email (str): The email of the user asking the question.
+    chart (str): The name of the chart related to the question.
+    question (Question): The question being asked.
+    session (Session): The database session.
+    user (UserBase): The user of the access token.
+
+    Returns:
+    tuple[Evaluation, list[dict], list[dict], int]: The evaluation, which is new
+    and not yet saved for the first question, the chat history sent as context,
+    the new messages, and the sequence number of the first new message.
 
+    Raises:
+    HTTPException: 400 if user, chart, or question is not provided.
+    HTTPException: 401 if the user is not authorized.
+    HTTPException: 404 if the chart is not found.
+    """
     if not email or not chart:
         raise HTTPException(status_code=400, detail="Email and chart must be provided")
 
     if not question.question:
         raise HTTPException(status_code=400, detail="Question must be provided")
 
-    await verify_user(token, session)
-
-    payload = jwt.decode(token, JWT_KEY, algorithms=["HS256"])
-    if payload["email"] != email:
-        raise HTTPException(status_code=401, detail=f"'{payload['email']}' is not authorized to access evaluation for '{email}'")
+    if user.email != email:
+        raise HTTPException(status_code=401, detail=f"'{user.email}' is not authorized to access evaluation for '{email}'")
 
-    statement = select(Evaluation).where(Evaluation.email == email).where(Evaluation.chart == chart).order_by(Evaluation.timestamp)
+    statement = select(Evaluation).where(Evaluation.email == email).where(Evaluation.chart == chart).order_by(Evaluation.timestamp.desc()).limit(1)
     db_evaluation = session.exec(statement).first()
 
     if not db_evaluation:
@@ -143,66 +254,167 @@ async def ask_question(email: str, chart: str, question: Question, session: Sess
             "content": [
                 {
                     "type": "text",
-                    "text": f"{question.question}"
+                    "text": question.question
                 },
                 {
                     "type": "image_url",
                     "image_url": {
-                        "url": f"{db_chart.url}"
+                        "url": db_chart.url
                     }
                 }
             ]
         }
 
-        chat = await send_request_to_openai([instruction, first_question])
-        chat_json = json.dumps(chat).encode('utf-8')
+        chat_history, next_seq = [], 0
+        new_messages = [instruction, first_question]
 
-        db_evaluation = Evaluation(
-            email=email,
-            chart=chart,
-            timestamp=datetime.now(timezone.utc),
-            chat_history=chat_json
-        )
-
-        session.add(db_evaluation)
-        session.commit()
-        session.refresh(db_evaluation)
+        db_evaluation = Evaluation(email=email, chart=chart)
 
     else:
-        try:
-            chat_history: list = json.loads(db_evaluation.chat_history.decode('utf-8'))
-        except json.JSONDecodeError:
-            raise HTTPException(status_code=500, detail="Failed to decode existing chat history")
+        chat_history, next_seq = load_chat_context(db_evaluation.id, session)
 
         new_question = {
             "role": "user",
             "content": [
                 {
                     "type": "text",
-                    "text": f"{question.question}"
+                    "text": question.question
                 }
             ]
         }
-        chat_history.append(new_question)
+        new_messages = [new_question]
 
-        chat_history = await send_request_to_openai(chat_history)
+    return db_evaluation, chat_history, new_messages, next_seq
 
-        updated_chat_history = json.dumps(chat_history).encode('utf-8')
+def save_messages(db_evaluation: Evaluation, new_messages: list[dict], next_seq: int, session: Session):
+    """
+    Save the new messages of an evaluation and mark it as updated.
 
-        db_evaluation.chat_history = updated_chat_history
-        db_evaluation.timestamp = datetime.now(timezone.utc)
-        session.add(db_evaluation)
-        session.commit()
-        session.refresh(db_evaluation)
+    Args:
+    db_evaluation (Evaluation): The evaluation the messages belong to.
+    new_messages (list[dict]): The messages to save, in order.
+    next_seq (int): The sequence number of the first new message.
+    session (Session): The database session.
+    """
+    # SQLite drops the time zone, so the UTC time is kept naive here as well. The
+    # returned evaluation then has the same timestamp as when it is read back.
+    db_evaluation.timestamp = datetime.now(timezone.utc).replace(tzinfo=None)
+    session.add(db_evaluation)
+    session.flush()
+
+    for seq, message in enumerate(new_messages, start=next_seq):
+        session.add(ChatMessage(
+            evaluation_id=db_evaluation.id,
+            seq=seq,
+            role=message["role"],
+            content=message["content"],
+            created_at=db_evaluation.timestamp
+        ))
+
+    session.commit()
+
+def save_streamed_messages(db_evaluation: Evaluation, new_messages: list[dict], next_seq: int):
+    """
+    Save the messages of a streamed answer in a session of their own.
 
-    return db_evaluation
+    The request's session is already closed once the response starts streaming.
 
+    Args:
+    db_evaluation (Evaluation): The evaluation the messages belong to.
+    new_messages (list[dict]): The messages to save, in order.
+    next_seq (int): The sequence number of the first new message.
+    """
+    with Session(engine, expire_on_commit=False) as session:
+        save_messages(db_evaluation, new_messages, next_seq, session)
+
+def evaluation_etag(evaluation: Evaluation) -> str:
+    """
+    Build the ETag of an evaluation.
+
+    The timestamp of an evaluation is updated on every question, so together
+    with the id it changes whenever the chat history does.
+
+    Args:
+    evaluation (Evaluation): The evaluation.
+
+    Returns:
+    str: The quoted ETag.
+    """
+    return f'"{evaluation.id}-{evaluation.timestamp.isoformat()}"'
+
+def load_chat_history(evaluation_id: int, session: Session) -> list[dict]:
+    """
+    Load the chat history of an evaluation in the order it was written.
+
+    Args:
+    evaluation_id (int): The id of the evaluation.
+    session (Session): The database session.
+
+    Returns:
+    list[dict]: The chat messages with their role and content.
+    """
+    statement = select(ChatMessage.role, ChatMessage.content).where(ChatMessage.evaluation_id == evaluation_id).order_by(ChatMessage.seq)
+    return [{"role": role, "content": content} for role, content in session.exec(statement)]
 
-async def send_request_to_openai(chat: list):
+def load_chat_context(evaluation_id: int, session: Session) -> tuple[list[dict], int]:
     """
-    Non-blocking HTTP request to OpenAI API using aiohttp
+    Load the part of the chat history that is sent to OpenAI with a new question.
+
+    The system instruction and the first question, which carries the chart
+    image, are always kept. Of the remaining messages only the last MAX_TURNS
+    question/answer pairs are loaded, so the request size stays bounded no
+    matter how long the conversation gets.
+
+    Args:
+    evaluation_id (int): The id of the evaluation.
+    session (Session): The database session.
+
+    Returns:
+    tuple[list[dict], int]: The chat messages with their role and content, and
+    the sequence number of the next message.
+    """
+    columns = (ChatMessage.role, ChatMessage.content, ChatMessage.seq)
+    head_statement = select(*columns).where(ChatMessage.evaluation_id == evaluation_id).where(ChatMessage.seq < 2).order_by(ChatMessage.seq)
+    tail_statement = select(*columns).where(ChatMessage.evaluation_id == evaluation_id).where(ChatMessage.seq >= 2).order_by(ChatMessage.seq.desc()).limit(2 * MAX_TURNS)
+
+    rows = session.exec(head_statement).all() + session.exec(tail_statement).all()[::-1]
+    next_seq = rows[-1].seq + 1 if rows else 0
+
+    return [{"role": role, "content": content} for role, content, _ in rows], next_seq
+
+
+def server_sent_event(data: dict) -> str:
+    """
+    Format a Server-Sent Event that carries a JSON object.
+
+    Args:
+    data (dict): The event data.
+
+    Returns:
+    str: The event, terminated by a blank line.
+    """
+    return f"data: {orjson.dumps(data).decode('utf-8')}\n\n"
+
+@asynccontextmanager
+async def openai_response(chat: list, http: aiohttp.ClientSession, stream: bool = False):
+    """
+    Post a chat to the OpenAI chat completions API using the shared aiohttp session.
+
+    Responses with a transient status (502, 503, 504) are retried up to
+    OPENAI_RETRIES times with exponential backoff. The successful response
+    is released when the context exits.
+
+    Args:
+    chat (list): The chat messages to send.
+    http (aiohttp.ClientSession): The shared HTTP client session.
+    stream (bool): Whether OpenAI should stream the answer.
+
+    Yields:
+    aiohttp.ClientResponse: The successful response.
+
+    Raises:
+    HTTPException: 502 if OpenAI answers with an error status.
     """
-    url = "https://api.openai.com/v1/chat/completions"
     headers = {
         "Content-Type": "application/json",
         "Authorization": f"Bearer {OPENAI_KEY}"
@@ -211,23 +423,42 @@ async def send_request_to_openai(chat: list):
     data = {
         "model": "gpt-4o-mini",
         "messages": chat,
-        "max_completion_tokens": 300
+        "max_completion_tokens": 300,
+        "stream": stream
     }
 
-    timeout = aiohttp.ClientTimeout(total=30)  # 30 second timeout
-    
+    for attempt in range(OPENAI_RETRIES + 1):
+        response = await http.post(OPENAI_URL, headers=headers, json=data)
+        if response.status in OPENAI_RETRY_STATUSES and attempt < OPENAI_RETRIES:
+            response.release()
+            await asyncio.sleep(OPENAI_BACKOFF * 2 ** attempt)
+            continue
+
+        if response.status != 200:
+            error_text = await response.text()
+            response.release()
+            raise HTTPException(
+                status_code=502, 
+                detail=f"OpenAI API error: {response.status} - {error_text}"
+            )
+        break
+
+    try:
+        yield response
+    finally:
+        response.release()
+
+async def send_request_to_openai(chat: list, http: aiohttp.ClientSession):
+    """
+    Non-blocking HTTP request to OpenAI API using the shared aiohttp session
+
+    Responses with a transient status (502, 503, 504) are retried up to
+    OPENAI_RETRIES times with exponential backoff.
+    """
     try:
-        async with aiohttp.ClientSession(timeout=timeout) as session:
-            async with session.post(url, headers=headers, json=data) as response:
-                if response.status != 200:
-                    error_text = await response.text()
-                    raise HTTPException(
-                        status_code=502, 
-                        detail=f"OpenAI API error: {response.status} - {error_text}"
-                    )
-                
-                response_dict = await response.json()
-                
+        async with openai_response(chat, http) as response:
+            response_dict = await response.json()
+
         first_message = response_dict["choices"][0]["message"]
         role = first_message["role"]
         content = first_message["content"]
@@ -240,4 +471,40 @@ async def send_request_to_openai(chat: list):
     except aiohttp.ClientError as e:
         raise HTTPException(status_code=502, detail=f"Failed to connect to OpenAI API: {str(e)}")
     except KeyError as e:
-        raise HTTPException(status_code=502, detail=f"Unexpected OpenAI API response format: {str(e)}")
\ No newline at end of file
+        raise HTTPException(status_code=502, detail=f"Unexpected OpenAI API response format: {str(e)}")
+
+async def stream_openai_answer(chat: list, http: aiohttp.ClientSession):
+    """
+    Stream the answer to a chat from the OpenAI API using the shared aiohttp session.
+
+    Args:
+    chat (list): The chat messages to send.
+    http (aiohttp.ClientSession): The shared HTTP client session.
+
+    Yields:
+    str: The parts of the answer as OpenAI generates them.
+
+    Raises:
+    HTTPException: 502 if OpenAI answers with an error or can't be reached.
+    HTTPException: 504 if the request to OpenAI times out.
+    """
+    try:
+        async with openai_response(chat, http, stream=True) as response:
+            async for line in response.content:
+                if not line.startswith(b"data: "):
+                    continue
+
+                data = line[len(b"data: "):].strip()
+                if data == b"[DONE]":
+                    break
+
+                choices = orjson.loads(data)["choices"]
+                if choices and choices[0]["delta"].get("content"):
+                    yield choices[0]["delta"]["content"]
+
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="OpenAI API request timed out")
+    except aiohttp.ClientError as e:
+        raise HTTPException(status_code=502, detail=f"Failed to connect to OpenAI API: {str(e)}")
+    except (KeyError, ValueError) as e:
+        raise HTTPException(status_code=502, detail=f"Unexpected OpenAI API response format: {str(e)}")
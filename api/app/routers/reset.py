@@ -1,17 +1,16 @@
 import io
-import os
 import csv
+import secrets
 
 from typing import Annotated
-from dotenv import load_dotenv
 from fastapi import APIRouter, Depends, File, HTTPException, Header, Request, UploadFile
-from requests import Session
-from sqlmodel import delete
+from sqlmodel import Session, delete, insert
 
+from app.config import get_settings
 from app.dependencies import get_session
 from app.routers.users import User
 from app.routers.charts import Chart
-from app.routers.evaluations import Evaluation
+from app.routers.evaluations import ChatMessage, Evaluation
 
 router = APIRouter(
     prefix="/reset", 
@@ -20,11 +19,26 @@ router = APIRouter(
 
 SessionDep = Annotated[Session, Depends(get_session)]
 
-load_dotenv()
-KEY=os.getenv("KEY")
+KEY = get_settings().key
+
+BATCH_SIZE = 1000
+
+def is_valid_key(authorization: str) -> bool:
+    """
+    Check the secret key from the Authorization header in constant time.
+
+    Args:
+        authorization: The value of the Authorization header.
+
+    Returns:
+        True if the key matches the configured secret key.
+    """
+    if KEY is None:
+        return False
+    return secrets.compare_digest(authorization.encode(), KEY.encode())
 
 @router.post("/users")
-async def reset_users(session: SessionDep, authorization: Annotated[str, Header()],file: UploadFile = File(...)):
+def reset_users(session: SessionDep, authorization: Annotated[str, Header()],file: UploadFile = File(...)):
     """
     Reset all users in the database and add a new set of users from an uploaded CSV file.
 
@@ -46,36 +60,40 @@ async def reset_users(session: SessionDep, authorization: Annotated[str, Header(
         HTTPException: If the secret key is invalid.
     """
 
-    if authorization != KEY:
+    if not is_valid_key(authorization):
         raise HTTPException(status_code=403, detail="Invalid secret key")
     
-    statement = delete(User)
-    session.exec(statement)
-
-    admin_user = User(
-        username="admin",
-        email="admin@example.com",
-        disabled=False,
-        type="admin"
-    )
-    session.add(admin_user)
-
-    file_content = io.TextIOWrapper(file.file, encoding="utf-8")
-    csv_reader = csv.DictReader(file_content)
-    for row in csv_reader:
-        user = User(
-            username=row["username"],
-            email=row.get("email", "Unknown"),
-            disabled=row.get("disabled", "False").lower() == "true",
-            type=row.get("type", "user")
-        )
-        session.add(user)
-
-    session.commit()
+    with session.begin():
+        statement = delete(User)
+        session.exec(statement)
+
+        batch = [{
+            "username": "admin",
+            "email": "admin@example.com",
+            "disabled": False,
+            "type": "admin"
+        }]
+
+        file_content = io.TextIOWrapper(file.file, encoding="utf-8")
+        csv_reader = csv.DictReader(file_content)
+        for row in csv_reader:
+            batch.append({
+                "username": row["username"],
+                "email": row.get("email", "Unknown"),
+                "disabled": row.get("disabled", "False").lower() == "true",
+                "type": row.get("type", "user")
+            })
+            if len(batch) >= BATCH_SIZE:
+                session.exec(insert(User), params=batch)
+                batch.clear()
+
+        if batch:
+            session.exec(insert(User), params=batch)
+
     return {"message": "Users reset successfully"}
 
 @router.post("/charts")
-async def reset_charts(session: SessionDep, authorization: Annotated[str, Header()],file: UploadFile = File(...)):
+def reset_charts(session: SessionDep, authorization: Annotated[str, Header()],file: UploadFile = File(...)):
     """
     Reset charts data.
 
@@ -95,32 +113,39 @@ async def reset_charts(session: SessionDep, authorization: Annotated[str, Header
         HTTPException: If the secret key is invalid.
     """
 
-    if authorization != KEY:
+    if not is_valid_key(authorization):
         raise HTTPException(status_code=403, detail="Invalid secret key")
 
-    statement = delete(Chart)
-    session.exec(statement)
-
-    file_content = io.TextIOWrapper(file.file, encoding="utf-8")
-    csv_reader = csv.DictReader(file_content)
-    for row in csv_reader:
-        chart = Chart(
-            name=row["name"],
-            description=row["description"],
-            instruction=row["instruction"],
-            url=row["url"]
-        )
-        session.add(chart)
-
-    session.commit()
+    with session.begin():
+        statement = delete(Chart)
+        session.exec(statement)
+
+        batch = []
+        file_content = io.TextIOWrapper(file.file, encoding="utf-8")
+        csv_reader = csv.DictReader(file_content)
+        for row in csv_reader:
+            batch.append({
+                "name": row["name"],
+                "description": row["description"],
+                "instruction": row["instruction"],
+                "url": row["url"]
+            })
+            if len(batch) >= BATCH_SIZE:
+                session.exec(insert(Chart), params=batch)
+                batch.clear()
+
+        if batch:
+            session.exec(insert(Chart), params=batch)
+
     return {"message": "Charts reset successfully"}
 
 @router.post("/evaluations")
-async def reset_evaluations(request: Request, session: SessionDep, authorization: Annotated[str, Header()]): 
+def reset_evaluations(request: Request, session: SessionDep, authorization: Annotated[str, Header()]): 
     """
     Reset evaluation data.
 
-    This endpoint deletes all existing evaluation charts in the database.
+    This endpoint deletes all existing evaluations and their chat messages
+    in the database.
 
     Args:
         request: The request object.
@@ -134,8 +159,10 @@ async def reset_evaluations(request: Request, session: SessionDep, authorization
         HTTPException: If the secret key is invalid.
     """
 
-    if authorization != KEY:
+    if not is_valid_key(authorization):
         raise HTTPException(status_code=403, detail="Invalid secret key")
 
-    statement = delete(Evaluation)
-    session.exec(statement)
\ No newline at end of file
+    with session.begin():
+        session.exec(delete(ChatMessage))
+        statement = delete(Evaluation)
+        session.exec(statement)
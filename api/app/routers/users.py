@@ -1,19 +1,20 @@
 import jwt
-import os
-import random
-import string
+import secrets
+import time
 
-from datetime import datetime, timedelta, timezone
+from datetime import datetime, timezone
 from typing import Annotated, Optional
-from fastapi import APIRouter, Depends, HTTPException, Form, Header
+from fastapi import APIRouter, Depends, HTTPException, Form
+from fastapi.responses import ORJSONResponse
+from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 from pydantic import BaseModel, EmailStr
-from sqlmodel import Field, SQLModel, Session, select
-from dotenv import load_dotenv
+from sqlalchemy import exists, lambda_stmt
+from sqlmodel import Field, SQLModel, Session, delete, select
 
+from app.auth_cache import JWT_KEY_BYTES, cache_verified_user, decode_cached, forget_token, get_verified_user
 from app.dependencies import get_session
 
-load_dotenv()
-JWT_KEY = os.getenv("JWT_KEY")
+_TOKEN_TTL_SEC = 7 * 86400
 
 class UserBase(SQLModel):
     email: EmailStr
@@ -33,7 +34,7 @@ class TokenBase(SQLModel):
 
 class RevokedToken(TokenBase, table=True):
     id: int | None = Field(default=None, primary_key=True)
-    token: str
+    token: str = Field(index=True, unique=True)
     expires_at: datetime
 
 class TokenRequest(BaseModel):
@@ -46,8 +47,11 @@ router = APIRouter(
 
 SessionDep = Annotated[Session, Depends(get_session)] 
 
+bearer = HTTPBearer(auto_error=False)
+BearerDep = Annotated[HTTPAuthorizationCredentials | None, Depends(bearer)]
+
 @router.post("/login")
-async def login_user(email: Annotated[EmailStr, Form()], session: SessionDep):
+def login_user(email: Annotated[EmailStr, Form()], session: SessionDep):
     """
     Log in a user and issue an access token.
 
@@ -67,20 +71,19 @@ async def login_user(email: Annotated[EmailStr, Form()], session: SessionDep):
 
     db_user = session.get(User, email)
     if not db_user:
-        db_user = User(email=email, username=''.join(random.choices(string.ascii_letters + string.digits, k=6)), disabled=False, type='user')
+        db_user = User(email=email, username=secrets.token_urlsafe(5)[:6], disabled=False, type='user')
         session.add(db_user)
         session.commit()
-        session.refresh(db_user)
 
     if db_user.disabled:
         raise HTTPException(status_code=401, detail="User is disabled")
 
-    access_token = await issue_access_token(email)
+    access_token = issue_access_token(email)
 
     return {"access_token": access_token}
 
 @router.post("/verify", response_model=UserBase)
-async def verify_access_token(request: TokenRequest, session: SessionDep):
+def verify_access_token(request: TokenRequest, session: SessionDep):
     """
     Verify an access token.
 
@@ -97,29 +100,10 @@ async def verify_access_token(request: TokenRequest, session: SessionDep):
     HTTPException: 401 if the token is invalid or has expired.
     HTTPException: 404 if the user associated with the token does not exist.
     """
-    token = request.token
-    try:
-        payload = jwt.decode(token, JWT_KEY, algorithms=["HS256"])
-        email = payload["email"]
-
-        db_user = session.get(User, email)
-        if not db_user:
-            raise HTTPException(status_code=404, detail="User not found")
-        if db_user.disabled:
-            raise HTTPException(status_code=401, detail="User is disabled")
-
-        revoked_query = select(RevokedToken).where(RevokedToken.token == token)
-        revoked_token = session.exec(revoked_query).first()
-        if revoked_token:
-            raise HTTPException(status_code=401, detail="Access token has been revoked")
-        
-        return db_user
-    except jwt.ExpiredSignatureError:
-        raise HTTPException(status_code=401, detail="Access token has expired")
-    except jwt.InvalidTokenError:
-        raise HTTPException(status_code=401, detail="Invalid access token")
+    user = verify_user(request.token, session)
+    return ORJSONResponse(user.model_dump(mode="json"))
 
-async def issue_access_token(email: str):
+def issue_access_token(email: str):
     """
     Issue an access token for a user.
 
@@ -132,8 +116,8 @@ async def issue_access_token(email: str):
     Returns:
         str: The issued access token
     """
-    payload = {"email": email, "exp": datetime.now(tz=timezone.utc) + timedelta(days=7)}
-    return jwt.encode(payload, JWT_KEY, algorithm="HS256")
+    payload = {"email": email, "exp": int(time.time()) + _TOKEN_TTL_SEC}
+    return jwt.encode(payload, JWT_KEY_BYTES, algorithm="HS256")
 
 
 @router.post("/revoke")
@@ -142,7 +126,9 @@ def revoke_access_token(request: TokenRequest, session: SessionDep):
     Revoke an access token.
 
     This endpoint revokes an access token and makes it invalid for
-    authentication. The token is added to the RevokedToken table.
+    authentication. The token is added to the RevokedToken table, and
+    revoked tokens that have expired in the meantime are removed from it,
+    since an expired token is rejected anyway.
 
     Args:
     token: The access token to revoke.
@@ -157,28 +143,26 @@ def revoke_access_token(request: TokenRequest, session: SessionDep):
     """
     token = request.token    
     try:
-        payload: dict = jwt.decode(token, JWT_KEY, algorithms=["HS256"])
+        payload: dict = decode_cached(token)
         email = payload["email"]
 
         db_user = session.get(User, email)
         if not db_user:
             raise HTTPException(status_code=404, detail="User not found")
         
-        revoked_query = select(RevokedToken).where(RevokedToken.token == token)
-        revoked_token = session.exec(revoked_query).first()
-        if revoked_token:
+        is_revoked = session.scalar(select(exists().where(RevokedToken.token == token)))
+        if is_revoked:
             raise HTTPException(status_code=400, detail="Token is already revoked")
 
-        expires_at = payload.get("exp", None)
-        if expires_at:
-            expires_at = datetime.fromtimestamp(expires_at, tz=timezone.utc)
-        else:
-            raise HTTPException(status_code=400, detail="Invalid token expiration")
+        expires_at = datetime.fromtimestamp(payload["exp"], tz=timezone.utc)
+
+        prune_statement = delete(RevokedToken).where(RevokedToken.expires_at < datetime.now(timezone.utc))
+        session.exec(prune_statement)
 
         revoked_instance = RevokedToken(token=token, expires_at=expires_at)
         session.add(revoked_instance)
         session.commit()
-        session.refresh(revoked_instance)
+        forget_token(token)
 
         return {"message": "Access token revoked successfully"}
     except jwt.ExpiredSignatureError:
@@ -186,79 +170,132 @@ def revoke_access_token(request: TokenRequest, session: SessionDep):
     except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Invalid access token")
     
-def verify_if_admin(token: str, session: SessionDep):
+def verify_user(token: str, session: SessionDep, *, require_admin: bool = False) -> UserBase:
     """
-    Verify if the user associated with the access token is an admin.
+    Verify if the user associated with the access token is a user.
 
-    This function verifies the access token and checks if the user associated
-    with the token is an admin. If the token is invalid, revoked, or expired,
-    it raises an HTTPException with a 401 status code. If the user is not an
-    admin, it raises an HTTPException with a 401 status code.
+    This function decodes the access token and loads the user together with
+    the revocation status of the token in a single query. If the token is
+    invalid, revoked, or expired, it raises an HTTPException with a 401
+    status code. Successfully verified tokens are cached for a few seconds,
+    so repeated requests with the same token skip the decode and the query.
 
     Args:
     token: The access token to verify.
     session: The database session.
+    require_admin: Whether the user must be an admin.
+
+    Returns:
+    The user associated with the access token.
 
     Raises:
     HTTPException: 401 if the access token is invalid, revoked, or expired.
-    HTTPException: 401 if the user is not an admin.
+    HTTPException: 401 if the user is disabled, or not an admin when `require_admin` is set.
+    HTTPException: 404 if the user associated with the token does not exist.
     """
-    try:
-        payload = jwt.decode(token, JWT_KEY, algorithms=["HS256"])
-        email = payload["email"]
-        # Verify that the user exists and is active
-        db_user = session.get(User, email)
-        if not db_user:
+    user = get_verified_user(token)
+    if not user:
+        try:
+            payload = decode_cached(token)
+        except jwt.ExpiredSignatureError:
+            raise HTTPException(status_code=401, detail="Access token has expired")
+        except jwt.InvalidTokenError:
+            raise HTTPException(status_code=401, detail="Invalid access token")
+
+        row = session.exec(user_with_revocation_statement(payload["email"], token)).first()
+        if not row:
             raise HTTPException(status_code=404, detail="User not found")
+
+        db_user, is_revoked = row
         if db_user.disabled:
             raise HTTPException(status_code=401, detail="User is disabled")
-
-        revoked_query = select(RevokedToken).where(RevokedToken.token == token)
-        revoked_token = session.exec(revoked_query).first()
-        if revoked_token:
+        if is_revoked:
             raise HTTPException(status_code=401, detail="Access token has been revoked")
-        
-        if not db_user.type == "admin":
-            raise HTTPException(status_code=401, detail="User is not admin")
-        
-    except jwt.ExpiredSignatureError:
-        raise HTTPException(status_code=401, detail="Access token has expired")
-    except jwt.InvalidTokenError:
-        raise HTTPException(status_code=401, detail="Invalid access token")
-    
-async def verify_user(token: str, session: SessionDep):
+
+        user = UserBase.model_validate(db_user)
+        cache_verified_user(token, user, payload["exp"])
+
+    if require_admin and user.type != "admin":
+        raise HTTPException(status_code=401, detail="User is not admin")
+
+    return user
+
+def user_with_revocation_statement(email: str, token: str):
     """
-    Verify if the user associated with the access token is a user.
+    Build the query that loads a user together with the revocation status
+    of a token.
 
-    This function verifies the access token and checks if the user associated
-    with the token is a user. If the token is invalid, revoked, or expired,
-    it raises an HTTPException with a 401 status code. If the user is not a
-    user, it raises an HTTPException with a 401 status code.
+    The query is a lambda statement, so SQLAlchemy constructs and caches it
+    once and only binds the email and token on later calls.
+
+    Args:
+    email: The email of the user to load.
+    token: The access token to check for revocation.
+
+    Returns:
+    A statement selecting the user and a `revoked` boolean.
+    """
+    return lambda_stmt(
+        lambda: select(User, exists().where(RevokedToken.token == token).label("revoked")).where(User.email == email)
+    )
+
+def bearer_token(credentials: Optional[HTTPAuthorizationCredentials]) -> str:
+    """
+    Return the access token from the parsed Bearer credentials.
+
+    Args:
+    credentials: The Bearer credentials from the Authorization header.
+
+    Returns:
+    The access token.
+
+    Raises:
+    HTTPException: 401 if the header is missing or not a Bearer token.
+    """
+    if credentials is None:
+        raise HTTPException(status_code=401, detail="Invalid token format")
+
+    return credentials.credentials
+
+def current_user(session: SessionDep, credentials: BearerDep) -> UserBase:
+    """
+    FastAPI dependency that returns the user of the request's access token.
+
+    The Bearer token is parsed from the Authorization header by `HTTPBearer`
+    and verified once, so endpoints don't have to parse and decode the token
+    themselves.
 
     Args:
-    token: The access token to verify.
     session: The database session.
+    credentials: The Bearer credentials from the Authorization header.
+
+    Returns:
+    The user associated with the access token.
 
     Raises:
-    HTTPException: 401 if the access token is invalid, revoked, or expired.
-    HTTPException: 401 if the user is not a user.
+    HTTPException: 401 if the header is missing, not a Bearer token, invalid, revoked, or expired.
+    HTTPException: 404 if the user associated with the token does not exist.
     """
-    try:
-        payload = jwt.decode(token, JWT_KEY, algorithms=["HS256"])
-        email = payload["email"]
+    return verify_user(bearer_token(credentials), session)
 
-        db_user = session.get(User, email)
-        if not db_user:
-            raise HTTPException(status_code=404, detail="User not found")
-        if db_user.disabled:
-            raise HTTPException(status_code=401, detail="User is disabled")
+CurrentUserDep = Annotated[UserBase, Depends(current_user)]
 
-        revoked_query = select(RevokedToken).where(RevokedToken.token == token)
-        revoked_token = session.exec(revoked_query).first()
-        if revoked_token:
-            raise HTTPException(status_code=401, detail="Access token has been revoked")
-        
-    except jwt.ExpiredSignatureError:
-        raise HTTPException(status_code=401, detail="Access token has expired")
-    except jwt.InvalidTokenError:
-        raise HTTPException(status_code=401, detail="Invalid access token")
\ No newline at end of file
+def admin_user(session: SessionDep, credentials: BearerDep) -> UserBase:
+    """
+    FastAPI dependency that returns the user of the request's access token
+    if that user is an admin.
+
+    Args:
+    session: The database session.
+    credentials: The Bearer credentials from the Authorization header.
+
+    Returns:
+    The verified admin user.
+
+    Raises:
+    HTTPException: 401 if the token is invalid, revoked, or expired, or the user is not an admin.
+    HTTPException: 404 if the user associated with the token does not exist.
+    """
+    return verify_user(bearer_token(credentials), session, require_admin=True)
+
+AdminUserDep = Annotated[UserBase, Depends(admin_user)]
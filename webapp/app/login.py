@@ -1,8 +1,7 @@
-import requests
 from nicegui import ui, app
-from utils import get_css_file_path, SERVER_URI
+from utils import CSS_STYLE, api_request, read_json
 
-def on_login(email: str):
+async def on_login(email: str):
     """Login to the server with the given username and password.
 
     If the login is successful, set the access token and user information in the
@@ -14,10 +13,14 @@ def on_login(email: str):
         'email': email
     }
     
-    response = requests.post(f'{SERVER_URI}/users/login', data=form_data)
-
-    if response.status_code == 200:
-        access_token = dict(response.json()).get('access_token')
+    # Logging in again only issues another token, so it is safe to retry.
+    async with api_request('POST', '/users/login', data=form_data) as response:
+        body = await read_json(response)
+
+    if response.status == 200:
+        access_token = dict(body).get('access_token')
+        # The list of charts is cached per login, so the new login fetches it again.
+        app.storage.user.pop('charts', None)
         app.storage.user.update({
             'access_token': access_token,
             'email': email,
@@ -25,10 +28,10 @@ def on_login(email: str):
         })
         ui.navigate.to('/evaluation')
     else:
-        ui.notify(response.json())
+        ui.notify(body)
 
 def render_login_page():
-    ui.add_css(get_css_file_path())
+    ui.add_head_html(CSS_STYLE)
 
     with ui.header(elevated=True).style('background-color: var(--primary-color);').classes('items-center justify-between h-20'):
         ui.label('AI Pomočnik').classes('text-2xl text-white pl-4')
@@ -1,10 +1,10 @@
+import aiohttp
+import asyncio
 import os
-import json
-import requests
 
-from nicegui import ui, app, run
+from nicegui import ui, app
 
-from utils import require_authentication, get_image_url, get_charts, get_button_color, get_button_classes, get_css_file_path, logout, SERVER_URI
+from utils import require_authentication, get_image_url, get_charts, CSS_STYLE, logout, get_evaluation, stream_question, evaluation_changed, open_http_session, close_http_session, SessionExpired
 
 from login import render_login_page
 from dotenv import load_dotenv
@@ -14,6 +14,11 @@ load_dotenv()
 
 STORAGE_KEY = os.getenv('STORAGE_KEY')
 
+ACTIVE_BUTTON_COLOR = 'var(--primary-color)'
+INACTIVE_BUTTON_COLOR = 'var(--disabled-color)'
+ACTIVE_BUTTON_CLASSES = 'text-white text-lg'
+INACTIVE_BUTTON_CLASSES = 'text-black text-lg'
+
 @ui.page('/')
 def root_page():
     ui.navigate.to('/login')
@@ -32,18 +37,45 @@ async def evaluation_page():
     evaluation page is rendered.
     """
 
+    # Data fetched from the server for this page and the shown chat messages, shared by the functions below.
+    # The number of chart switches tells a streamed answer whether its chart is still shown.
+    page_data = {'chart_switches': 0}
+    # Evaluations loaded on this page with their ETags, by chart ID.
+    evaluations = {}
+
+    async def load_page_data():
+        """
+        Fetch the current chart, the list of charts and the evaluation
+        concurrently, so the page waits for the slowest request only.
+
+        The list of charts is kept in the user storage, so it is only
+        fetched once per login.
+        """
+        if 'charts' in app.storage.user:
+            await load_chart_data()
+            return
+
+        image, charts, page_data['evaluation'] = await asyncio.gather(get_image_url(), get_charts(), get_evaluation(evaluations))
+        page_data['image_url'], page_data['image_description'] = image
+        app.storage.user.update({'charts': charts})
+
+    async def load_chart_data():
+        """
+        Fetch the data that depends on the current chart concurrently.
+        """
+        image, page_data['evaluation'] = await asyncio.gather(get_image_url(), get_evaluation(evaluations))
+        page_data['image_url'], page_data['image_description'] = image
+
     @ui.refreshable
-    async def show_chart():
-        image_url, image_description = await get_image_url()
+    def show_chart():
         with ui.card().classes('w-full h-fit max-h-[40rem]'):
-            ui.image(image_url).props('fit="contain"')
+            ui.image(page_data['image_url']).props('fit="contain"')
             with ui.card_section():
-                ui.label(image_description)
+                ui.label(page_data['image_description'])
 
     @ui.refreshable
-    async def show_image():
-        image_url, image_description = await get_image_url()
-        ui.image(image_url).classes('w-full h-full').props('fit="scale-down"')
+    def show_image():
+        ui.image(page_data['image_url']).classes('w-full h-full').props('fit="scale-down"')
 
     @ui.refreshable
     async def show_textarea_or_spinner():
@@ -57,79 +89,107 @@ async def evaluation_page():
             ui.button(color='var(--primary-color)', text='Pošlji vprašanje', on_click=lambda: handle_question_submit(question.value)).classes('w-full text-white mt-4 mx-8 mb-16 lg:mx-16 xl:mx-32')
 
     @ui.refreshable
-    async def show_chart_buttons():
-        charts = await get_charts() 
-        
-        for idx, chart in enumerate(charts):
-            ui.button(f'{idx + 1}', color=get_button_color(chart), on_click=lambda c=chart: set_chart(c)).classes(get_button_classes(chart)).tooltip(f'Graf {idx + 1}')
+    def show_chart_buttons():
+        active_chart = app.storage.user.get('chart_id')
+        for idx, chart in enumerate(app.storage.user['charts']):
+            active = chart == active_chart
+            color = ACTIVE_BUTTON_COLOR if active else INACTIVE_BUTTON_COLOR
+            classes = ACTIVE_BUTTON_CLASSES if active else INACTIVE_BUTTON_CLASSES
+            ui.button(f'{idx + 1}', color=color, on_click=lambda c=chart: set_chart(c)).classes(classes).tooltip(f'Graf {idx + 1}')
+
+    def format_message(message: dict) -> str:
+        """
+        Format a chat message as a markdown block with the translated role.
+        """
+        role = message['role']
+        content = message['content']
+
+        if role == "user" and isinstance(content, list):
+            content = " ".join(item['text'] for item in content if item['type'] == 'text')
+
+        translated_role = "Uporabnik" if role == "user" else "AI Pomočnik"
+
+        return f"**{translated_role}**\n\n{content}"
+
+    def show_message(message_block: str, last: bool) -> ui.markdown:
+        """
+        Show a formatted message, highlighting it if it is the last one.
+        """
+        if last:
+            return ui.markdown(message_block).classes('highlight-last p-2').props('id="last-message"')
+        return ui.markdown(f"---\n\n{message_block}\n\n").classes('p-2 w-full')
+
+    def scroll_to_last_message():
+        ui.run_javascript("""
+            const last = document.getElementById('last-message');
+            if (last) {
+                last.scrollIntoView({ behavior: 'smooth', block: 'start' });
+            }
+        """)
 
     @ui.refreshable
-    async def get_evaluation_text(markdown_ui: ui.markdown, scroll_area: ui.scroll_area):
+    def get_evaluation_text(markdown_ui: ui.markdown, scroll_area: ui.scroll_area):
         """
         Get the evaluation text for the current user and chart id
-        by querying the server and parsing the response.
+        from the evaluation loaded from the server.
 
         If the response is valid, it will display the chat history
         in a markdown format. If the response is invalid, it will
         display a message asking the user to ask a question.
-        """
-        url = f"{SERVER_URI}/evaluations/{app.storage.user.get('email')}/{app.storage.user.get('chart_id')}"
-        headers = {"Authorization": f"Bearer {app.storage.user.get('access_token')}"}
-        response = requests.get(url, headers=headers)
 
+        The messages are shown in the chat area, so new messages can be
+        appended to it without rendering the whole history again.
+        """
+        page_data['chat_area'] = ui.column().classes('w-full gap-0')
         try:
-            response = json.loads(json.dumps(response.json()))
-            history =json.loads(response['chat_history'])
-
-            roles = []
-            contents = []
-            for index, message in enumerate(history):
-                role = message['role']
-                content = message['content']
-                
-                if role == "user" and isinstance(content, list):
-                    content = " ".join(item['text'] for item in content if item['type'] == 'text')
-
-                roles.append(role)
-                contents.append(content)
-
-            markdown_content = ""
-            markdown_ui.clear()
-            for i, (role, content) in enumerate(zip(roles[1:], contents[1:])):
-                translated_role = "Uporabnik" if role == "user" else "AI Pomočnik"
-
-                message_block = f"**{translated_role}**\n\n{content}"
-
-                if i == len(roles[1:]) - 1:
-                    ui.markdown(message_block).classes('highlight-last p-2').props('id="last-message"')
-                else:
-                    ui.markdown("---\n\n" + message_block + "\n\n").classes('p-2 w-full')
-            
-            markdown_ui.set_content(markdown_content.strip())
-            ui.run_javascript("""
-                const last = document.getElementById('last-message');
-                if (last) {
-                    last.scrollIntoView({ behavior: 'smooth', block: 'start' });
-                }
-            """)
+            history = page_data['evaluation']['chat_history']
+
+            # The first message is the system instruction, which is not shown.
+            messages = history[1:]
+            with page_data['chat_area']:
+                # Everything before the last message is one markdown element, so the
+                # browser gets a single element to parse instead of one per message.
+                if len(messages) > 1:
+                    show_message("\n\n---\n\n".join(format_message(message) for message in messages[:-1]), last=False)
+                if messages:
+                    page_data['last_message'] = show_message(format_message(messages[-1]), last=True)
+
+            # Hide the placeholder text; this sends nothing if it is already empty.
+            markdown_ui.set_content('')
+            scroll_to_last_message()
         except KeyError:
             markdown_ui.set_content('**Tukaj bodo prikazani odgovori AI pomočnika, potem ko jih postavite.**')
 
     async def set_chart(chart_id):
+        # Clicking the active chart changes nothing, so skip the reload and the refreshes.
+        if app.storage.user.get('chart_id') == chart_id:
+            return
+
         app.storage.user.update({'chart_id': chart_id})
+        page_data['chart_switches'] += 1
+        shown_evaluation = page_data['evaluation']
+        try:
+            await load_chart_data()
+        except SessionExpired:
+            return
         show_chart.refresh()
         show_image.refresh()
         show_chart_buttons.refresh()
-        get_evaluation_text.refresh()
+        if evaluation_changed(shown_evaluation, page_data['evaluation']):
+            get_evaluation_text.refresh()
 
     async def handle_question_submit(question: str):
         app.storage.user.update({'is_loading': True})
         show_textarea_or_spinner.refresh()
 
-        await submit_question(question)
-
-        app.storage.user.update({'is_loading': False})
-        show_textarea_or_spinner.refresh()
+        try:
+            await submit_question(question)
+        except SessionExpired:
+            pass  # The user is sent to the login page, only the loading state is reset.
+        finally:
+            # The loading state is persisted, so it is reset even if the request failed.
+            app.storage.user.update({'is_loading': False})
+            show_textarea_or_spinner.refresh()
 
     async def submit_question(question: str):
         """
@@ -142,23 +202,84 @@ async def evaluation_page():
             ui.notify('Please enter a question.')
             return
 
-        url = f"{SERVER_URI}/evaluations/{app.storage.user.get('email')}/{app.storage.user.get('chart_id')}"
-        headers = {"Authorization": f"Bearer {app.storage.user.get('access_token')}"}
+        # The answer belongs to this chart even if another one is selected while it streams.
+        chart_id = app.storage.user.get('chart_id')
+        chart_switches = page_data['chart_switches']
 
-        # Run the POST request in a background thread
-        await run.io_bound(requests.post, url, headers=headers, json={'question': question})
+        # Show the question and the answer as it is streamed, below the chat history.
+        with page_data['chat_area']:
+            question_ui = show_message(f"**Uporabnik**\n\n{question}", last=False)
+            answer_ui = ui.markdown().classes('highlight-last p-2')
 
-        get_evaluation_text.refresh()
+        def remove_streamed_messages():
+            for element in (question_ui, answer_ui):
+                if not element.is_deleted:
+                    element.delete()
+
+        parts = []
+        evaluation = None
+        try:
+            async for event in stream_question(question):
+                # If another chart was selected in the meantime, the answer is still read to the
+                # end so the server saves it, but it is not shown with the other chart's history.
+                if page_data['chart_switches'] != chart_switches:
+                    remove_streamed_messages()
+
+                if event['type'] == 'delta':
+                    parts.append(event['content'])
+                    answer_ui.set_content(f"**AI Pomočnik**\n\n{''.join(parts)}")
+                elif event['type'] == 'done':
+                    evaluation = event['evaluation']
+                else:
+                    ui.notify(event['detail'], color='red')
+        except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+            # The connection to the server was lost, so the half streamed answer is removed.
+            remove_streamed_messages()
+            ui.notify(f'Napaka pri povezavi s strežnikom: {error}', color='red')
+            return
+
+        if not evaluation or page_data['chart_switches'] != chart_switches:
+            remove_streamed_messages()
+
+            # This chart was selected again before the answer ended, so the shown history
+            # may or may not have the answer yet. Load it again from the server.
+            if evaluation and app.storage.user.get('chart_id') == chart_id:
+                page_data['evaluation'] = await get_evaluation(evaluations)
+                get_evaluation_text.refresh()
+            return
+
+        # Add the new messages to the history instead of downloading it again.
+        # The first message is the system instruction, which is not shown.
+        history = page_data['evaluation'].get('chat_history')
+        page_data['evaluation'] = {**evaluation, 'chat_history': (history or [{'role': 'system', 'content': ''}]) + [
+            {'role': 'user', 'content': question},
+            {'role': 'assistant', 'content': ''.join(parts)},
+        ]}
+
+        if not history:
+            get_evaluation_text.refresh()
+            return
+
+        # Keep the streamed messages and only move the highlight to the new answer.
+        previous = page_data['last_message']
+        previous.set_content(f"---\n\n{previous.content}\n\n")
+        previous.classes(add='w-full', remove='highlight-last').props(remove='id')
+        answer_ui.props('id="last-message"')
+        page_data['last_message'] = answer_ui
+        scroll_to_last_message()
 
     async def render_evaluation_page():
-        ui.add_css(get_css_file_path())
+        try:
+            await load_page_data()
+        except SessionExpired:
+            return
 
         if 'is_loading' not in app.storage.user:
             app.storage.user.update({'is_loading': False})
         
         with ui.dialog() as dialog, ui.card(align_items='end').classes('w-full h-full').style('max-width: none'):
             ui.button('X', on_click=dialog.close)
-            await show_image()
+            show_image()
 
         with ui.header(elevated=True).style('background-color: var(--primary-color);').classes('flex items-center justify-between h-20 px-4'):
             with ui.row().classes('items-center'):
@@ -171,16 +292,16 @@ async def evaluation_page():
             with ui.column().classes('w-full h-full xl:w-2/5'):   
                 with ui.row(align_items='center').classes('h-fit w-full justify-center').style('background-color: #e0e7eb'):
                     with ui.element('div').on('click', dialog.open).classes('w-full h-full cursor-pointer p-4').tooltip('Kliknite za povečavo slike'):
-                            await show_chart()
+                            show_chart()
 
                 with ui.row(align_items='start').classes('gap-4 w-full h-fit justify-center pt-8 px-4').style('background-color: #e0e7eb'):
-                    await show_chart_buttons()
+                    show_chart_buttons()
 
             with ui.column().classes('w-full h-fit xl:w-3/5'):
                 with ui.row(align_items='center').classes('h-full w-full justify-center px-8 lg:px-32 pt-8 text-lg').style('background-color: #e0e7eb'):
                     with ui.scroll_area().classes('min-h-[20rem] xl:min-h-[30rem]') as scroll_area:
                         markdown_ui = ui.markdown()
-                        await get_evaluation_text(markdown_ui, scroll_area)
+                        get_evaluation_text(markdown_ui, scroll_area)
                 with ui.row(align_items='start').classes('h-full w-full min-h-80').style('background-color: #e0e7eb'):
                     await show_textarea_or_spinner()
                         
@@ -188,14 +309,26 @@ async def evaluation_page():
             ui.label('Tilen Tratnjek - Univerza v Mariboru 2025').classes('pl-4 text-sm text-gray-200')
 
 
+    # Part of the initial HTML, so the page is styled from the first paint.
+    ui.add_head_html(CSS_STYLE)
     spinner = ui.spinner(size=30).classes('absolute-center')  # Show a spinner while checking authentication
     
     async def check_authentication():
-        user_data = require_authentication()
+        user_data = await require_authentication()
         if user_data:
             spinner.delete()
             await render_evaluation_page()
 
+    # Send the page with the spinner right away, and verify the token and
+    # load the data once the browser is connected, instead of holding back
+    # the whole response until every API call has returned.
+    try:
+        await ui.context.client.connected(timeout=30)
+    except TimeoutError:
+        return  # The browser never connected; reloading the page starts over.
     await check_authentication()
 
+app.on_startup(open_http_session)
+app.on_shutdown(close_http_session)
+
 ui.run(title='My App', storage_secret=STORAGE_KEY)
\ No newline at end of file
@@ -1,10 +1,102 @@
-import requests
+import aiohttp
+import asyncio
+import base64
+import logging
+import orjson
+import os
+import time
 
+from cachetools import TTLCache
+from contextlib import asynccontextmanager
+from dotenv import load_dotenv
 from pathlib import Path
-from nicegui import ui, app
+from nicegui import background_tasks, ui, app
+
+load_dotenv()
+
+# The API address, "http://api:80" on the Docker network unless set in the environment.
+SERVER_URI = os.getenv('SERVER_URI', 'http://api:80')
+
+logger = logging.getLogger(__name__)
+
+# Async client for all calls to the API, so they don't block the event loop.
+# Shared across all users so connections to the API are kept alive and reused.
+# The access token is per user, so it is sent per request, never set on the session.
+# Opened on app startup and closed on shutdown.
+HTTP: aiohttp.ClientSession | None = None
+
+# Transient API failures are retried with exponential backoff.
+API_RETRIES = 3
+API_BACKOFF = 0.2
+API_RETRY_STATUSES = (502, 503, 504)
+
+# Connect and read timeouts for every call to the API. A streamed answer may
+# wait longer before its first part, since the API waits for OpenAI in the
+# meantime: up to three attempts of 30 seconds each, plus the backoff between them.
+API_TIMEOUT = aiohttp.ClientTimeout(connect=3, sock_read=10)
+STREAM_TIMEOUT = aiohttp.ClientTimeout(connect=3, sock_read=100)
+
+# Tokens closer than this to their expiry are verified with the API again.
+TOKEN_EXPIRY_MARGIN_SEC = 30
+# Verified tokens older than this are checked again in the background.
+REVERIFY_AFTER_SEC = 300
+
+# Image URL and description by chart ID. Charts are the same for every user.
+# Entries expire, so chart changes made through the API show up without a restart.
+CHART_CACHE_TTL_SEC = 300
+_CHART_CACHE: TTLCache[str, tuple[str, str]] = TTLCache(maxsize=256, ttl=CHART_CACHE_TTL_SEC)
+
+async def open_http_session():
+    global HTTP
+    HTTP = aiohttp.ClientSession(
+        base_url=SERVER_URI,
+        timeout=API_TIMEOUT,
+        json_serialize=lambda obj: orjson.dumps(obj).decode('utf-8')
+    )
+
+@asynccontextmanager
+async def api_request(method: str, url: str, idempotent: bool = True, **kwargs):
+    """Send a request to the API with the shared session, retrying transient failures.
+
+    Responses with a 502, 503 or 504 status and connection errors are retried up to
+    API_RETRIES times with exponential backoff. Requests that are not safe to repeat
+    are only retried if the connection could not be opened, so they never reached
+    the API. The response is released when the context exits.
+
+    Args:
+        method (str): The HTTP method.
+        url (str): The path of the endpoint.
+        idempotent (bool): Whether the request is safe to send more than once.
+        **kwargs: Passed on to `aiohttp.ClientSession.request`.
+
+    Yields:
+        aiohttp.ClientResponse: The last response received.
+    """
+    for attempt in range(API_RETRIES + 1):
+        try:
+            response = await HTTP.request(method, url, **kwargs)
+        except aiohttp.ClientConnectionError as e:
+            if attempt == API_RETRIES or not (idempotent or isinstance(e, aiohttp.ClientConnectorError)):
+                raise
+        else:
+            if not idempotent or response.status not in API_RETRY_STATUSES or attempt == API_RETRIES:
+                break
+            response.release()
+        await asyncio.sleep(API_BACKOFF * 2 ** attempt)
+
+    try:
+        yield response
+    finally:
+        response.release()
+
+async def read_json(response: aiohttp.ClientResponse):
+    """Decode a JSON response body with orjson, straight from the bytes."""
+    return orjson.loads(await response.read())
+
+async def close_http_session():
+    if HTTP:
+        await HTTP.close()
 
-#SERVER_URI = "http://api:80"
-SERVER_URI = "http://127.0.0.1:8000"
 def logout():
     app.storage.user.clear()
     ui.navigate.to('/login')
@@ -12,23 +104,97 @@ def logout():
 def get_css_file_path():
     return str(Path(__file__).parent / 'main.css')
 
-def verify_token() -> dict | None:
+# The stylesheet is read once at import, not on every page load, and added to
+# the page head as is, since ui.add_css would first check if the text is a file path.
+CSS_STYLE = f"<style>{Path(get_css_file_path()).read_text(encoding='utf-8')}</style>"
+
+class SessionExpired(Exception):
+    """The API rejected the access token of the current user."""
+
+def check_authorized(response: aiohttp.ClientResponse):
+    """Send the user to the login page if the API rejected their access token.
+
+    The token can be revoked or the user disabled while the verified user is still
+    cached, so an API call is the first to notice. The cached user is dropped, so
+    the token is verified again on the next page load.
+
+    Args:
+        response (aiohttp.ClientResponse): The response of an API call made with the token.
+
+    Raises:
+        SessionExpired: If the response is a 401, so the caller stops rendering.
+    """
+    if response.status == 401:
+        app.storage.user.pop('verified_user', None)
+        ui.navigate.to('/login')
+        raise SessionExpired()
+
+def auth_headers() -> dict:
+    return {"Authorization": f"Bearer {app.storage.user.get('access_token')}"}
+
+def token_expiry(access_token: str) -> float:
+    """Read the expiry time of an access token without verifying its signature.
+
+    The token was issued to this user by the API and is kept in the server-side
+    user storage, so it can be trusted to check how long it stays valid.
+
+    Args:
+        access_token (str): The JWT access token.
+
+    Returns:
+        float: The expiry as a Unix timestamp, or 0 if the token cannot be read.
+    """
+    try:
+        payload = access_token.split('.')[1]
+        return orjson.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))['exp']
+    except (ValueError, KeyError, IndexError, TypeError):
+        return 0
+
+async def verify_token() -> dict | None:
     access_token = app.storage.user.get('access_token', None)
     if not access_token:
-        print('Access token is empty, please login.')
+        logger.debug('Access token is empty, please login.')
         return None
-    data = {'token': access_token}
-    response = requests.post(f'{SERVER_URI}/users/verify', json=data)
 
-    if response.status_code != 200:
-        ui.notify(response.json())
+    # A token that was verified before and is not about to expire is not sent to the API again.
+    verified = app.storage.user.get('verified_user')
+    if verified and verified['token'] == access_token and token_expiry(access_token) - time.time() > TOKEN_EXPIRY_MARGIN_SEC:
+        # Check it again without waiting for the answer, so a revoked token
+        # or a disabled user is noticed on the next page load.
+        if time.time() - verified.get('verified_at', 0) > REVERIFY_AFTER_SEC:
+            background_tasks.create(post_verify(access_token), name='reverify_token')
+        return verified['user']
+
+    user_data, error = await post_verify(access_token)
+    if error:
+        ui.notify(error)
         return None
+    return user_data
 
-    user_data = response.json()
-    return user_data 
+async def post_verify(access_token: str) -> tuple[dict | None, dict | None]:
+    """Verify an access token with the API and remember the result.
 
-def require_authentication(required_type=None):
-    user_data = verify_token()
+    The verified user is kept in the user storage with the token, and removed
+    if the token is rejected.
+
+    Args:
+        access_token (str): The access token to verify.
+
+    Returns:
+        tuple: The user data and None, or None and the error returned by the server.
+    """
+    async with api_request('POST', '/users/verify', json={'token': access_token}) as response:
+        body = await read_json(response)
+
+    if response.status != 200:
+        app.storage.user.pop('verified_user', None)
+        return None, body
+
+    app.storage.user.update({'verified_user': {'token': access_token, 'user': body, 'verified_at': time.time()}})
+    return body, None
+
+async def require_authentication(required_type=None):
+    user_data = await verify_token()
     if not user_data:
         ui.notify('Access denied: Please login first.', color='red')
         ui.timer(3.0, lambda: ui.navigate.to('/login'), once=True)
@@ -44,30 +210,28 @@ async def get_image_url():
     """Get the image URL and description for the current chart ID.
 
     Query the server with the current chart ID and access token to get the image URL and description.
+    The result is cached per chart ID for CHART_CACHE_TTL_SEC seconds.
 
     Args:
         None
 
     Returns:
         tuple: A tuple of the image URL and description.
-    """
-    url = f"{SERVER_URI}/charts/{app.storage.user.get('chart_id')}"
-    headers = {"Authorization": f"Bearer {app.storage.user.get('access_token')}"}
-    response = requests.get(url, headers=headers).json()
-    return response['url'], response['description']
 
+    Raises:
+        SessionExpired: If the API rejected the access token.
+    """
+    chart_id = app.storage.user.get('chart_id')
+    cached = _CHART_CACHE.get(chart_id)
+    if cached:
+        return cached
 
-def get_button_classes(chart_id):
-    active_button = app.storage.user.get('chart_id', None)
-    if active_button == chart_id:
-        return 'text-white text-lg'
-    return 'text-black text-lg'
+    async with api_request('GET', f"/charts/{chart_id}", headers=auth_headers()) as response:
+        check_authorized(response)
+        chart = await read_json(response)
+    _CHART_CACHE[chart_id] = image = chart['url'], chart['description']
+    return image
 
-def get_button_color(chart_id):
-    active_button = app.storage.user.get('chart_id', None)
-    if active_button == chart_id:
-        return 'var(--primary-color)'
-    return 'var(--disabled-color)'
 
 async def get_charts():
     """Get the list of charts from the server.
@@ -79,9 +243,86 @@ async def get_charts():
 
     Returns:
         list: A list of chart names.
+
+    Raises:
+        SessionExpired: If the API rejected the access token.
+    """
+    async with api_request('GET', "/charts/", headers=auth_headers()) as response:
+        check_authorized(response)
+        charts = await read_json(response)
+
+    return [chart['name'] for chart in charts]
+
+async def get_evaluation(cache: dict | None = None):
+    """Get the evaluation of the current user for the current chart ID.
+
+    Evaluations in the cache are revalidated with their ETag, so an unchanged
+    evaluation is not downloaded again.
+
+    Args:
+        cache (dict | None): Evaluations already loaded, with their ETags, by chart ID.
+
+    Returns:
+        dict: The evaluation with its chat history, or the error returned by the server.
+
+    Raises:
+        SessionExpired: If the API rejected the access token.
+    """
+    chart_id = app.storage.user.get('chart_id')
+    url = f"/evaluations/{app.storage.user.get('email')}/{chart_id}"
+    headers = auth_headers()
+
+    cached = cache.get(chart_id) if cache is not None else None
+    if cached:
+        headers['If-None-Match'] = cached['etag']
+
+    async with api_request('GET', url, headers=headers) as response:
+        if response.status == 304:
+            return cached['evaluation']
+        check_authorized(response)
+        evaluation = await read_json(response)
+        etag = response.headers.get('ETag')
+
+    if cache is not None and etag:
+        cache[chart_id] = {'etag': etag, 'evaluation': evaluation}
+    return evaluation
+
+async def stream_question(question: str):
+    """Ask a question about the current chart ID and stream the answer.
+
+    Args:
+        question (str): The question to submit to the server.
+
+    Yields:
+        dict: The events sent by the server, a `delta` with the next part of the
+        answer, then either `done` with the updated evaluation or `error`.
+
+    Raises:
+        SessionExpired: If the API rejected the access token.
     """
-    url = f"{SERVER_URI}/charts/"
-    headers = {"Authorization": f"Bearer {app.storage.user.get('access_token')}"}
-    response = requests.get(url, headers=headers).json()
+    url = f"/evaluations/{app.storage.user.get('email')}/{app.storage.user.get('chart_id')}/stream"
+    async with api_request('POST', url, idempotent=False, headers=auth_headers(), json={'question': question}, timeout=STREAM_TIMEOUT) as response:
+        check_authorized(response)
+        if response.status != 200:
+            error = await read_json(response)
+            yield {'type': 'error', 'detail': error.get('detail')}
+            return
+
+        async for line in response.content:
+            if line.startswith(b'data: '):
+                yield orjson.loads(line[len(b'data: '):])
+
+def evaluation_changed(shown: dict, loaded: dict) -> bool:
+    """Check whether a newly loaded evaluation differs from the one shown.
+
+    The server updates the timestamp of an evaluation on every question, so the
+    ID and timestamp identify the chat history without comparing it.
 
-    return [chart['name'] for chart in response]
\ No newline at end of file
+    Args:
+        shown (dict): The evaluation currently shown.
+        loaded (dict): The evaluation loaded from the server.
+
+    Returns:
+        bool: True if the chat history has to be rendered again.
+    """
+    return (shown.get('id'), shown.get('timestamp')) != (loaded.get('id'), loaded.get('timestamp'))
\ No newline at end of file